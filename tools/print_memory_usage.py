@@ -32,13 +32,23 @@ Options:
                       together. Default: 1
   -v, --verbose       Print verbose output.
   -s, --show-waste    Show where RAM is wasted (due to padding)
+
+Requires the pyelftools Python package, and arm-none-eabi-c++filt or
+llvm-cxxfilt on the PATH to demangle symbol names.
 '''
 
-import os
+import array
+import collections
+import functools
+import operator
 import re
+import shutil
+import struct
+import subprocess
 import sys
 import getopt
-import cxxfilt   # Demanging C++/Rust symbol names
+from elftools.common.exceptions import ELFError
+from elftools.elf.elffile import ELFFile   # pyelftools, reading ELF headers
 
 
 verbose = False
@@ -48,16 +58,92 @@ symbol_depth = 1
 # A map of section name -> size
 sections = {}
 
-# These lists store 4-tuples:
-#    (name, start address, length of function, total size)
-# The "length of function" is the size of the symbol as reported in
-# objdump, which is the executable code. "Total size" includes any
-# constants embedded, including constant strings, or padding.
-# Initially the lists are populated with total_size=0; it is later
-# computed by sorting the symbols and calculating their spacing.
-kernel_uninitialized = []
-kernel_initialized = []
-kernel_functions = []
+class SymbolList(object):
+    """A list of symbols, stored as parallel arrays of names, start
+       addresses, lengths of function and total sizes.
+       The "length of function" is the size of the symbol as reported in
+       the ELF symbol table, which is the executable code. "Total size"
+       includes any constants embedded, including constant strings, or
+       padding. Initially the total sizes are 0; they are later computed by
+       sorting the symbols and calculating their spacing."""
+    def __init__(self):
+        self.names = []
+        self.addrs = array.array('Q')
+        self.sizes = array.array('Q')
+        self.totals = array.array('Q')
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, name, addr, size):
+        """Append a symbol, with a total size of 0."""
+        self.names.append(name)
+        self.addrs.append(addr)
+        self.sizes.append(size)
+        self.totals.append(0)
+
+    def sort_by_addr(self):
+        """Reorder all the arrays by start address."""
+        order = sorted(range(len(self.names)), key=self.addrs.__getitem__)
+        self.names = [self.names[i] for i in order]
+        self.addrs = array.array('Q', [self.addrs[i] for i in order])
+        self.sizes = array.array('Q', [self.sizes[i] for i in order])
+        self.totals = array.array('Q', [self.totals[i] for i in order])
+
+kernel_uninitialized = SymbolList()
+kernel_initialized = SymbolList()
+kernel_functions = SymbolList()
+
+# Symbols whose names may be mangled, as (SymbolList, index) pairs into the
+# kernel_ lists above. Their names are demangled all at once, after
+# parsing, by demangle_symbols().
+pending_demangle = []
+
+# A map of mangled name -> demangled name, filled in by demangle_symbols().
+demangled_names = {}
+
+def find_demangler():
+    """Return the command line of the first demangler found, or None.
+       Both tools are restricted to the gnu-v3 (Itanium) format, so that
+       they print the same names: otherwise GNU c++filt detects legacy
+       Rust names and prints trait implementations as <A as B>::f instead
+       of the _$LT$A$u20$as$u20$B$GT$::f form which parse_mangled_name
+       expects. GNU c++filt is tried first as it is the faster of the two."""
+    for (tool, args) in (('arm-none-eabi-c++filt', ['-n', '-s', 'gnu-v3']),
+                         ('llvm-cxxfilt', ['-n', '--format=gnu'])):
+        path = shutil.which(tool)
+        if path is not None:
+            return [path] + args
+    return None
+
+# The demangler command line, looked up once.
+CXXFILT = find_demangler()
+
+# The ELF sections reported on, without their leading '.'.
+REPORTED_SECTIONS = ('text', 'relocate', 'sram', 'stack', 'app_memory')
+
+# An Elf32_Sym entry of a little-endian ELF:
+#    (st_name, st_value, st_size, st_info, st_other, st_shndx)
+# The symbol table is decoded with this directly; going through pyelftools
+# for each symbol is several times slower than running objdump.
+_ELF32_SYM = struct.Struct('<IIIBBH')
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+STT_FUNC = 2
+STV_HIDDEN = 2
+
+# Patterns for symbol names, compiled once since they are matched against
+# every symbol.
+_TEXT_INNER_RE = re.compile(r'\$(((\w+\.\.)+)(\w+))\$')
+_HASH_RE = re.compile(r'h[0-9a-f]{16}')
+
+# Prefixes of symbols that aren't '::' delimited, one alternative per
+# group; the index of the matching alternative selects the group name.
+# These rules are based on observation: .Lanon*, anon.* and str.* are
+# embedded strings.
+_UNMANGLED_RE = re.compile(r'(\.Lanon|anon\.|str\.)|(\.hidden )|(_ZN)')
+_UNMANGLED_GROUPS = (None, "Constant strings", "ARM aeabi support",
+                     "Unidentified auto-generated")
 
 def usage(message):
     """Prints out an error message and usage"""
@@ -73,35 +159,54 @@ Options:
 
 
 
-def process_section_line(line):
-    """Parses a line from the Sections: header of an ELF objdump,
-       inserting it into a data structure keeping track of the sections."""
-    # pylint: disable=anomalous-backslash-in-string,line-too-long
-    match = re.search('^\S+\s+\.(text|relocate|sram|stack|app_memory)\s+(\S+).+', line)
-    if match != None:
-        sections[match.group(1)] = int(match.group(2), 16)
+def elf_format(elf):
+    """Return the objdump-style format name of the ELF, such as
+       elf32-littlearm or elf64-bigaarch64."""
+    machine = str(elf['e_machine'])
+    if machine.startswith('EM_'):
+        machine = machine[3:].lower()
+    endianness = "little" if elf.little_endian else "big"
+    return "elf%d-%s%s" % (elf.elfclass, endianness, machine)
+
+def section_segment(section):
+    """Return the name of a reported ELF section without its leading '.',
+       or None if the section isn't reported on."""
+    if section.name.startswith('.') and section.name[1:] in REPORTED_SECTIONS:
+        return section.name[1:]
+    return None
+
+def process_sections(elf):
+    """Read the section headers of the ELF, inserting the sizes of the
+       reported sections into a data structure keeping track of them."""
+    for section in elf.iter_sections():
+        segment = section_segment(section)
+        if segment is not None:
+            sections[segment] = section['sh_size']
 
  # Take a Rust-style symbol of '::' delineated names and trim the last
  # one if it is a hash.  Many symbols have hashes appended which just
  # hurt readability; they take the form of h[16-digit hex number].
+@functools.lru_cache(maxsize=None)
 def trim_hash_from_symbol(symbol):
     """If the passed symbol ends with a hash of the form h[16-hex number]
        trim this and return the trimmed symbol."""
-    # Remove the hash off the end
-    tokens = symbol.split('::')
-    last = tokens[-1]
-    if last[0] == 'h':
-        tokens = tokens[:-1] # Trim off hash if it exists
-        trimmed_name = "::".join(tokens) # reassemble
-        return trimmed_name
+    # Remove the hash off the end, without splitting the whole name
+    idx = symbol.rfind('::')
+    if idx != -1 and _HASH_RE.fullmatch(symbol, idx + 2):
+        return symbol[:idx]
     else:
         return symbol
 
+# Results are cached since the same names recur across sections; this
+# relies on demangled_names being complete before the first call.
+@functools.lru_cache(maxsize=None)
 def parse_mangled_name(name):
     """Take a potentially mangled symbol name and demangle it to its
-       name, removing the trailing hash. Raise a cxxflit.InvalidName exception
-       if it is not a mangled symbol."""
-    demangled = cxxfilt.demangle(name, external_only=False)
+       name, removing the trailing hash. Return None if it is not a
+       mangled symbol."""
+    demangled = demangled_names.get(name, name)
+    if demangled == name:
+        return None
     corrected_name = trim_hash_from_symbol(demangled)
     # Rust-specific mangled names triggered by Tock Components, e.g.
     # ZN100_$LT$capsules..ieee802154..driver..RadioDriver$u20$as$u20$capsules..ieee802154..device..RxClient$GT$7receive
@@ -119,52 +224,90 @@ def parse_mangled_name(name):
 
     return corrected_name
 
-def process_symbol_line(line):
-    """Parse a line the SYMBOL TABLE section of the objdump output and
-       insert its data into one of the three kernel_ symbol lists.
-       Because Tock executables have a variety of symbol formats,
-       first try to demangle it; if that fails, use it as is."""
-    # pylint: disable=line-too-long,anomalous-backslash-in-string
-    match = re.search('^(\S+)\s+\w+\s+\w*\s+\.(text|relocate|sram|stack|app_memory)\s+(\S+)\s+(.+)', line)
-    if match != None:
-        addr = int(match.group(1), 16)
-        segment = match.group(2)
-        size = int(match.group(3), 16)
-        name = match.group(4)
+def add_mangled_symbol(symbols, name, addr, size):
+    """Append a symbol whose name may be mangled to 'symbols'. The name is
+       kept as is until demangle_symbols() is called."""
+    # Mangled C++ and legacy Rust names start with _Z; anything else can
+    # be used as is. Rust v0 names (_R) are left alone too, since only
+    # some demanglers handle them in the gnu-v3 format used here.
+    if name.startswith('_Z'):
+        pending_demangle.append((symbols, len(symbols)))
+    symbols.append(name, addr, size)
+
+def demangle_symbols():
+    """Demangle the names of all symbols added with add_mangled_symbol().
+       Unique names are passed through a single c++filt process; names
+       that are not mangled are left unchanged."""
+    names = list({symbols.names[index] for (symbols, index) in pending_demangle})
+    if not names:
+        return
+    if CXXFILT is None:
+        usage("could not find arm-none-eabi-c++filt or llvm-cxxfilt")
+        sys.exit(-1)
+    try:
+        cxxfilt = subprocess.run(CXXFILT, input='\n'.join(names) + '\n',
+                                 stdout=subprocess.PIPE, universal_newlines=True,
+                                 check=True)
+    except subprocess.CalledProcessError as err:
+        usage(str(err))
+        sys.exit(-1)
+    demangled_names.update(zip(names, cxxfilt.stdout.splitlines()))
+
+    for (symbols, index) in pending_demangle:
+        demangled = parse_mangled_name(symbols.names[index])
+        if demangled is not None:
+            symbols.names[index] = demangled
+
+def process_symbol_table(elf):
+    """Read the symbol table of the ELF and insert its data into the three
+       kernel_ symbol lists.
+       Because Tock executables have a variety of symbol formats, names
+       are queued for demangling; those that fail to demangle are used
+       as is."""
+    symtab = elf.get_section_by_name('.symtab')
+    if symtab is None:
+        return
+    strtab = elf.get_section(symtab['sh_link']).data()
+    segments = [section_segment(section) for section in elf.iter_sections()]
+    for (st_name, addr, size, info, other, shndx) in \
+            _ELF32_SYM.iter_unpack(symtab.data()):
+        # Zero-sized symbols (section symbols, markers such as _etext)
+        # take no space and aren't reported, so don't keep them. Neither
+        # are undefined or absolute symbols, which have no section.
+        if size == 0 or shndx == SHN_UNDEF or shndx >= SHN_LORESERVE:
+            continue
+        segment = segments[shndx]
+        if segment not in ("relocate", "sram", "text"):
+            continue
+        # Clear the Thumb bit of function addresses, as objdump does.
+        if info & 0xf == STT_FUNC:
+            addr = addr & ~1
+        name = strtab[st_name:strtab.find(b'\0', st_name)].decode('utf-8', 'replace')
+        # Keep the visibility prefix objdump prints; group_symbols uses
+        # it to recognize ARM aeabi support functions.
+        if other & 0x3 == STV_HIDDEN:
+            name = ".hidden " + name
 
         # Initialized data: part of the flash image, then copied into RAM
         # on start. The .data section in normal hosted C.
         if segment == "relocate":
-            try:
-                demangled = parse_mangled_name(name)
-                kernel_initialized.append((demangled, addr, size, 0))
-            except cxxfilt.InvalidName:
-                kernel_initialized.append((name, addr, size, 0))
+            add_mangled_symbol(kernel_initialized, name, addr, size)
 
         # Uninitialized data, stored in a zeroed RAM section. The
         # .bss section in normal hosted C.
         elif segment == "sram":
-            try:
-                demangled = parse_mangled_name(name)
-                kernel_uninitialized.append((demangled, addr, size, 0))
-            except cxxfilt.InvalidName:
-                kernel_uninitialized.append((name, addr, size, 0))
+            add_mangled_symbol(kernel_uninitialized, name, addr, size)
 
         # Code and embedded data.
         elif segment == "text":
-            # pylint: disable=anomalous-backslash-in-string
-            match = re.search('\$(((\w+\.\.)+)(\w+))\$', name)
-            if match != None:
-                symbol = match.group(1)
+            path_match = _TEXT_INNER_RE.search(name)
+            if path_match is not None:
+                symbol = path_match.group(1)
                 symbol = symbol.replace('..', '::')
                 symbol = trim_hash_from_symbol(symbol)
-                kernel_functions.append((symbol, addr, size, 0))
+                kernel_functions.append(symbol, addr, size)
             else:
-                try:
-                    symbol = parse_mangled_name(name)
-                    kernel_functions.append((symbol, addr, size, 0))
-                except cxxfilt.InvalidName:
-                    kernel_functions.append((name, addr, size, 0))
+                add_mangled_symbol(kernel_functions, name, addr, size)
 
 def print_section_information():
     """Print out the ELF's section information (RAM and Flash use)."""
@@ -176,7 +319,7 @@ def print_section_information():
     if "app_memory" in sections:  # H1-style linker file, static app section
         app_size = sections["app_memory"]
     else: # Mainline Tock-style linker file, using APP_MEMORY
-        for (name, addr, size, tsize) in kernel_uninitialized:
+        for (name, size) in zip(kernel_uninitialized.names, kernel_uninitialized.sizes):
             if name.find("APP_MEMORY") >= 0:
                 app_size = size
 
@@ -193,6 +336,18 @@ def print_section_information():
     print("  " + "{:>6}".format(sram_size + relocate_size) + "\tvariables total")
     print("Applications allocated " + str(app_size) + " bytes of RAM")
 
+def split_at_depth(symbol, depth):
+    """Split a '::' delimited symbol after its first 'depth' names. Return
+       the leading names with a trailing '::', and the remaining names."""
+    if depth == 0:
+        return ("::", symbol)
+    cut = -2
+    for _ in range(depth):
+        cut = symbol.find("::", cut + 2)
+        if cut == -1:
+            return (symbol + "::", "")
+    return (symbol[:cut + 2], symbol[cut + 2:])
+
 # Take a list of 'symbols' and group them into in 'groups' as aggregates
 # for condensing. Names are '::' delimited hierarchies. The aggregate
 # sizes are determined by the global symbol depth, which indicates how
@@ -201,39 +356,29 @@ def print_section_information():
 # aggregate symbols into top level categories (e.g, 'h1::*'). A depth
 # of 100 means aggregate symbols only if they have the same first 100
 # name levels, so effectively print every symbol individually.
+# 'groups' is a collections.defaultdict(list).
 #
-# The 'waste' and 'section' parameters are used to specify whether detected
-# waste should be printed and the name of the section for waste information.
-def group_symbols(groups, symbols, waste, section):
+# The symbols must have gone through compute_padding(), whose result is
+# passed as 'waste_sum'. The 'waste' and 'section' parameters are used to
+# specify whether detected waste should be printed and the name of the
+# section for waste information.
+def group_symbols(groups, symbols, waste_sum, waste, section):
     """Take a list of symbols and group them into 'groups' for reporting
        aggregate flash/RAM use."""
     global symbol_depth
-    expected_addr = 0
-    waste_sum = 0
-    prev_symbol = ""
-    for (symbol, addr, size, _) in symbols:
-        if size == 0:
-            continue
-        # If we find a gap between symbol+size and the next symbol, we might
-        # have waste. But this is only true if it's not the first symbol and
-        # this is actually a variable and just just a symbol (e.g., _estart)
-        if addr != expected_addr and expected_addr != 0 and size != 0 and (waste or verbose):
-            print("  ! " + str(addr - expected_addr) + " bytes wasted after " + prev_symbol)
-        waste_sum = waste_sum + (addr - expected_addr)
-        tokens = symbol.split("::")
+    for (symbol, size, total_size) in zip(symbols.names, symbols.sizes, symbols.totals):
+        # If there is a gap between symbol+size and the next symbol, we
+        # might have waste.
+        if total_size != size and (waste or verbose):
+            print("  ! " + str(total_size - size) + " bytes wasted after " + symbol)
         key = symbol[0] # Default to first character (_) if not a proper symbol
         name = symbol
 
-        if len(tokens) == 1:
-            # The symbol isn't a standard mangled Rust name. These rules are
-            # based on observation.
-            # .Lanon* and str.* are embedded string.
-            if symbol[0:6] == '.Lanon' or symbol[0:5] == "anon." or symbol[0:4] == 'str.':
-                key = "Constant strings"
-            elif symbol[0:8] == ".hidden ":
-                key = "ARM aeabi support"
-            elif symbol[0:3] == "_ZN":
-                key = "Unidentified auto-generated"
+        if "::" not in symbol:
+            # The symbol isn't a standard mangled Rust name.
+            match = _UNMANGLED_RE.match(symbol)
+            if match is not None:
+                key = _UNMANGLED_GROUPS[match.lastindex]
             else:
                 key = "Unmangled globals (C-like code)"
                 name = symbol
@@ -241,17 +386,9 @@ def group_symbols(groups, symbols, waste, section):
             # Packages have a trailing :: while other categories don't;
             # this allows us to disambiguate when * is relevant or not
             # in printing.
-            key = "::".join(tokens[0:symbol_depth]) + "::"
-            name = "::".join(tokens[symbol_depth:])
-
-            if key in groups.keys():
-                groups[key].append((name, size))
-            else:
-                groups[key] = [(name, size)]
+            (key, name) = split_at_depth(symbol, symbol_depth)
 
-        # Set state for next iteration
-        expected_addr = addr + size
-        prev_symbol = symbol
+        groups[key].append((name, size))
 
     if waste and waste_sum > 0:
         print("Total of " + str(waste_sum) + " bytes wasted in " + section)
@@ -261,7 +398,8 @@ def string_for_group(key, padding_size, group_size, num_elements):
        right; decides whether to add a * or not based on the name of the group
        and number of elements in it."""
     if num_elements == 1: # If there's a single symbol (a variable), print it.
-        key = key[:-2]
+        if key[-2:] == "::": # Categories such as "Constant strings" have no ::
+            key = key[:-2]
         key = key + ":"
         key = key.ljust(padding_size + 2, ' ')
         return ("  " + key + str(group_size) + " bytes\n")
@@ -278,27 +416,27 @@ def string_for_group(key, padding_size, group_size, num_elements):
 def print_groups(title, groups):
     """Print title, then all of the variable groups in groups."""
     group_sum = 0
-    output = ""
-    max_string_len = len(max(groups.keys(), key=len))
-    for key in sorted(groups.keys()):
+    output = []
+    max_string_len = len(max(groups, key=len))
+    for key in sorted(groups):
         symbols = groups[key]
 
         group_size = 0
         for (_, size) in symbols:
             group_size = group_size + size
 
-        output = output + string_for_group(key, max_string_len, group_size, len(symbols))
+        output.append(string_for_group(key, max_string_len, group_size, len(symbols)))
         group_sum = group_sum + group_size
 
     print(title + ": " + str(group_sum) + " bytes")
-    print(output, end = ' ')
+    print("".join(output), end = ' ')
 
 def print_symbol_information():
     """Print out all of the variable and function groups with their flash/RAM
        use."""
-    variable_groups = {}
-    group_symbols(variable_groups, kernel_initialized, show_waste, "RAM")
-    group_symbols(variable_groups, kernel_uninitialized, show_waste, "Flash+RAM")
+    variable_groups = collections.defaultdict(list)
+    group_symbols(variable_groups, kernel_initialized, padding_init, show_waste, "RAM")
+    group_symbols(variable_groups, kernel_uninitialized, padding_uninit, show_waste, "Flash+RAM")
     if (show_waste):
         print() # Place an newline after waste reports
 
@@ -307,34 +445,29 @@ def print_symbol_information():
     print()
     print("Embedded data (in flash): " + str(padding_text) + " bytes")
     print()
-    function_groups = {}
+    function_groups = collections.defaultdict(list)
     # Embedded constants in code (e.g., after functions) aren't counted
     # in the symbol's size, so detecting waste in code has too many false
     # positives.
-    group_symbols(function_groups, kernel_functions, False, "Flash")
+    group_symbols(function_groups, kernel_functions, padding_text, False, "Flash")
     print_groups("Function groups (in flash)", function_groups)
     print()
 
-def get_addr(symbol_entry):
-    """Helper function for sorting symbols by start address."""
-    return symbol_entry[1]
-
 def compute_padding(symbols):
-    """Calculate how much padding is in a list of symbols by comparing their
-       reporting size with the spacing with the next function and return
-       the total differences."""
-    symbols.sort(key=get_addr)
-    func_count = len(symbols)
-    diff = 0
-    for i in range(1, func_count):
-        (esymbol, eaddr, esize, _) = symbols[i - 1]
-        (_, laddr, _, _) = symbols[i]
-        total_size = laddr - eaddr
-        symbols[i - 1] = (esymbol, eaddr, esize, total_size)
-        if total_size != esize:
-            diff = diff + (total_size - esize)
-
-    return diff
+    """Sort a list of symbols by address and fill in their total size from
+       the spacing with the next symbol. Return the total difference with
+       their reported sizes, i.e. how much padding is in the list. The last
+       symbol has nothing after it and keeps its reported size."""
+    symbols.sort_by_addr()
+    if not symbols:
+        return 0
+    addrs = symbols.addrs
+    # Spacing between consecutive symbols, computed without a Python loop.
+    totals = array.array('Q', map(operator.sub, addrs[1:], addrs))
+    totals.append(symbols.sizes[-1])
+    symbols.totals = totals
+
+    return sum(totals) - sum(symbols.sizes)
 
 def parse_options(opts):
     """Parse command line options."""
@@ -376,41 +509,24 @@ except getopt.GetoptError as err:
     usage(str(err))
     sys.exit(-1)
 
-header_lines = os.popen('arm-none-eabi-objdump -f ' + elf_name).readlines()
-
 print("Tock memory usage report for " + elf_name)
-arch = "UNKNOWN"
 
-for hline in header_lines:
-    # pylint: disable=anomalous-backslash-in-string
-    hmatch = re.search('file format (\S+)', hline)
-    if hmatch != None:
-        arch = hmatch.group(1)
+try:
+    with open(elf_name, 'rb') as elf_file:
+        elf = ELFFile(elf_file)
+        arch = elf_format(elf)
         if arch != 'elf32-littlearm':
             usage(arch + " architecture not supported, only elf32-littlearm supportd")
             sys.exit(-1)
-
-if arch == "UNKNOWN":
-    usage("could not detect architecture of ELF")
+        process_sections(elf)
+        process_symbol_table(elf)
+# A malformed symbol table shows up as a short .symtab (struct.error)
+# or as a section index past the section headers (IndexError).
+except (IOError, ELFError, struct.error, IndexError) as err:
+    usage("could not read ELF: " + str(err))
     sys.exit(-1)
 
-objdump_lines = os.popen('arm-none-eabi-objdump -x ' + elf_name).readlines()
-objdump_output_section = "start"
-
-for oline in objdump_lines:
-    oline = oline.strip()
-    # First, move to a new section if we've reached it; use continue
-    # to break out and reduce nesting.
-    if oline == "Sections:":
-        objdump_output_section = "sections"
-        continue
-    elif oline == "SYMBOL TABLE:":
-        objdump_output_section = "symbol_table"
-        continue
-    elif objdump_output_section == "sections":
-        process_section_line(oline)
-    elif objdump_output_section == "symbol_table":
-        process_symbol_line(oline)
+demangle_symbols()
 
 padding_init = compute_padding(kernel_initialized)
 padding_uninit = compute_padding(kernel_uninitialized)